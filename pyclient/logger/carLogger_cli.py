@@ -30,6 +30,7 @@ import pkg_resources
 from colorlog import ColoredFormatter
 
 from logger.carLogger_client import CarLoggerClient
+from logger.carLogger_client import RECORD_FIELDS
 
 DISTRIBUTION_NAME = 'carLogger'
 
@@ -59,6 +60,18 @@ def setup_loggers(verbose_level):
     logger.setLevel(logging.DEBUG)
     logger.addHandler(create_console_handler(verbose_level))
 
+def add_precheck_arguments(parser):
+    '''Define the --dry-run and --precheck options of write commands.'''
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='only report which records the processor would reject')
+
+    parser.add_argument(
+        '--precheck',
+        action='store_true',
+        help='drop records the processor would reject before sending')
+
 def add_create_parser(subparsers, parent_parser):
     '''Define the "create" command line parsing.'''
     parser = subparsers.add_parser(
@@ -79,7 +92,7 @@ def add_create_parser(subparsers, parent_parser):
     parser.add_argument(
         'work_date',
         type=str,
-        help='date of the work')
+        help='date of the work in YYYY-MM-DD format')
 
     parser.add_argument(
         'brand',
@@ -97,6 +110,8 @@ def add_create_parser(subparsers, parent_parser):
         type=str,
         help='any text you want or empty string')
 
+    add_precheck_arguments(parser)
+
 def add_add_parser(subparsers, parent_parser):
     '''Define the "add" command line parsing.'''
     parser = subparsers.add_parser(
@@ -117,7 +132,7 @@ def add_add_parser(subparsers, parent_parser):
     parser.add_argument(
         'work_date',
         type=str,
-        help='date of the work')
+        help='date of the work in YYYY-MM-DD format')
 
     parser.add_argument(
         'work',
@@ -134,6 +149,8 @@ def add_add_parser(subparsers, parent_parser):
         type=str,
         help='any text you want or empty string')
 
+    add_precheck_arguments(parser)
+
 def add_delete_parser(subparsers, parent_parser):
     '''Define the "delete" command line parsing.'''
     parser = subparsers.add_parser(
@@ -154,7 +171,7 @@ def add_delete_parser(subparsers, parent_parser):
     parser.add_argument(
         'work_date',
         type=str,
-        help='date of the work')
+        help='date of the work in YYYY-MM-DD format')
 
     parser.add_argument(
         'work',
@@ -171,6 +188,8 @@ def add_delete_parser(subparsers, parent_parser):
         type=str,
         help='any text you want or empty string')
 
+    add_precheck_arguments(parser)
+
 def add_history_parser(subparsers, parent_parser):
     '''Define the "history" command line parsing.'''
     parser = subparsers.add_parser(
@@ -183,6 +202,53 @@ def add_history_parser(subparsers, parent_parser):
         type=str,
         help='VIN number of vehicle')
 
+def add_summary_parser(subparsers, parent_parser):
+    '''Define the "summary" command line parsing.'''
+    parser = subparsers.add_parser(
+        'summary',
+        help='shows latest mileage, last service and service count of vehicles',
+        parents=[parent_parser])
+
+    parser.add_argument(
+        'VIN',
+        type=str,
+        nargs='*',
+        help='VIN numbers of vehicles, all vehicles if omitted')
+
+def add_batch_parser(subparsers, parent_parser):
+    '''Define the "batch" command line parsing.'''
+    parser = subparsers.add_parser(
+        'batch',
+        help='send many create/add/delete records in one transaction',
+        parents=[parent_parser])
+
+    parser.add_argument(
+        'file',
+        type=str,
+        help='file with one record per line, e.g. '
+             'add,VIN,private_key,work_date,work,km_status,description')
+
+    parser.add_argument(
+        '--size',
+        type=int,
+        default=0,
+        help='records per transaction, all records in one if 0')
+
+    add_precheck_arguments(parser)
+
+def add_watch_parser(subparsers, parent_parser):
+    '''Define the "watch" command line parsing.'''
+    parser = subparsers.add_parser(
+        'watch',
+        help='prints updates of vehicles as they are committed',
+        parents=[parent_parser])
+
+    parser.add_argument(
+        'VIN',
+        type=str,
+        nargs='*',
+        help='VIN numbers of vehicles to watch, all vehicles if omitted')
+
 def create_parent_parser(prog_name):
     '''Define the -V/--version command line options.'''
     parent_parser = argparse.ArgumentParser(prog=prog_name, add_help=False)
@@ -218,6 +284,9 @@ def create_parser(prog_name):
     add_add_parser(subparsers, parent_parser)
     add_delete_parser(subparsers, parent_parser)
     add_history_parser(subparsers, parent_parser)
+    add_summary_parser(subparsers, parent_parser)
+    add_batch_parser(subparsers, parent_parser)
+    add_watch_parser(subparsers, parent_parser)
 
     return parser
 
@@ -225,7 +294,12 @@ def do_create(args):
     '''Implements the "create" subcommand by calling the client class.'''
     company = args.private_key
     VIN = args.VIN
-    client = CarLoggerClient(baseUrl=DEFAULT_URL, private_key=company, vin=VIN)
+    client = CarLoggerClient(baseUrl=DEFAULT_URL, private_key=company, vin=VIN,
+                             precheck=args.precheck)
+    if args.dry_run:
+        print_check(client, [("create", VIN, company, args.work_date, args.brand, args.model,
+                              args.description)])
+        return
     response = client.create(VIN, company, args.work_date, args.brand , args.model,  args.description)
     print("Response: {}".format(response))
 
@@ -233,7 +307,12 @@ def do_add(args):
     '''Implements the "add" subcommand by calling the client class.'''
     company = args.private_key
     VIN = args.VIN
-    client = CarLoggerClient(baseUrl=DEFAULT_URL, private_key=company, vin=VIN)
+    client = CarLoggerClient(baseUrl=DEFAULT_URL, private_key=company, vin=VIN,
+                             precheck=args.precheck)
+    if args.dry_run:
+        print_check(client, [("add", VIN, company, args.work_date, args.work, args.km_status,
+                              args.description)])
+        return
     response = client.add(VIN , company , args.work_date , args.work , args.km_status , args.description)
 
     print("Response: {}".format(response))
@@ -242,7 +321,12 @@ def do_delete(args):
     '''Implements the "add" subcommand by calling the client class.'''
     company = args.private_key
     VIN = args.VIN
-    client = CarLoggerClient(baseUrl=DEFAULT_URL, private_key=company, vin=VIN)
+    client = CarLoggerClient(baseUrl=DEFAULT_URL, private_key=company, vin=VIN,
+                             precheck=args.precheck)
+    if args.dry_run:
+        print_check(client, [("delete", VIN, company, args.work_date, args.work, args.km_status,
+                              args.description)])
+        return
     response = client.delete(VIN, company, args.work_date, args.work, args.km_status, args.description)
 
     print("Response: {}".format(response))
@@ -259,6 +343,78 @@ def do_history(args):
     else:
         raise Exception("Data not found: {}".format(args.VIN))
 
+def do_summary(args):
+    '''Implements the "summary" subcommand by calling the client class.'''
+    keyfile = '5b00c8e6e4c0a8507e14d14c8618ad7a22de4920550b69debc43c8b5bb2271c0'
+    client = CarLoggerClient(baseUrl=DEFAULT_URL, private_key=keyfile)
+    summaries = client.summaries(args.VIN or None)
+
+    for VIN in sorted(summaries):
+        summary = summaries[VIN]
+        print("{} {} {}: {} km, last service {}, {} services".format(
+            VIN, summary['brand'], summary['model'], summary['mileage'],
+            summary['last_service'], summary['service_count']))
+    for VIN in args.VIN:
+        if VIN not in summaries:
+            print("{}: no summary found".format(VIN))
+
+def do_batch(args):
+    '''Implements the "batch" subcommand by calling the client class.'''
+    records = []
+    with open(args.file) as batch_file:
+        for number, line in enumerate(batch_file, 1):
+            if not line.strip():
+                continue
+            record = line.strip().split(",")
+            # Commas in a value would silently shift or truncate fields
+            if len(record) != RECORD_FIELDS:
+                raise Exception("{} line {}: {} fields, expected {}".format(
+                    args.file, number, len(record), RECORD_FIELDS))
+            records.append(record)
+    if not records:
+        raise Exception("No records in {}".format(args.file))
+    client = CarLoggerClient(baseUrl=DEFAULT_URL, private_key=records[0][2],
+                             precheck=args.precheck)
+    if args.dry_run:
+        print_check(client, records)
+        return
+    if args.size <= 0:
+        response = client.batch(records)
+        print("Response: {}".format(response))
+        return
+
+    groups = [records[i:i + args.size]
+              for i in range(0, len(records), args.size)]
+    committed, invalid, lost = client.batch_many(groups)
+    print("Committed {}, rejected {} and lost {} of {} transactions "
+          "(window {}, queue full {} times, dropped {} times)".format(
+              committed, invalid, lost, len(groups), client.window,
+              client.rejections, client.dropped))
+    if client.doomed:
+        print("{} records were not sent".format(len(client.doomed)))
+
+def print_check(client, records):
+    '''Print which records the processor would accept or reject.'''
+    accepted, rejected = client.check(records)
+    for record, reason in rejected:
+        print("Would reject {}: {}".format(",".join(record), reason))
+    print("{} of {} records would be accepted".format(
+        len(accepted), len(records)))
+
+def do_watch(args):
+    '''Implements the "watch" subcommand by calling the client class.'''
+    keyfile = '5b00c8e6e4c0a8507e14d14c8618ad7a22de4920550b69debc43c8b5bb2271c0'
+    client = CarLoggerClient(baseUrl=DEFAULT_URL, private_key=keyfile)
+
+    def print_change(block_num, address, entry):
+        if entry is None:
+            print("Block {}: address {} removed".format(block_num, address))
+        else:
+            print("Block {}: vehicle with VIN: {} updated = {}".format(
+                block_num, entry.get('VIN'), entry))
+
+    client.watch(args.VIN, print_change)
+
 def _get_keyfile(customerName):
     '''Get the private key for a customer.'''
     home = os.path.expanduser("~")
@@ -285,6 +441,12 @@ def main(prog_name=os.path.basename(sys.argv[0]), args=None):
         do_delete(args)
     elif args.command == 'history':
         do_history(args)
+    elif args.command == 'summary':
+        do_summary(args)
+    elif args.command == 'batch':
+        do_batch(args)
+    elif args.command == 'watch':
+        do_watch(args)
     else:
         raise Exception("Invalid command: {}".format(args.command))
 
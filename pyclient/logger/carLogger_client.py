@@ -2,9 +2,14 @@
 This CarLoggerClient class interfaces with Sawtooth through the REST API.
 '''
 
+import asyncio
 import hashlib
 import base64
+import json
+import logging
 import random
+import time
+import aiohttp
 import requests
 import yaml
 
@@ -19,12 +24,91 @@ from sawtooth_sdk.protobuf.batch_pb2 import BatchList
 from sawtooth_sdk.protobuf.batch_pb2 import BatchHeader
 from sawtooth_sdk.protobuf.batch_pb2 import Batch
 
+LOGGER = logging.getLogger(__name__)
+
 # The Transaction Family Name
 FAMILY_NAME = 'carLogger'
 
+# Seconds to wait before reopening a dropped subscription websocket.
+WATCH_RECONNECT_DELAY = 5
+
+# Jittered exponential backoff (seconds) while the validator queue is full.
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+MAX_RETRIES = 8
+
+# Upper bound for the number of batches kept pending by batch_many().
+MAX_WINDOW = 64
+
+# Records the processor accepts, see CarLoggerTransactionHandler.
+OPERATIONS = ("create", "add", "delete")
+RECORD_FIELDS = 7
+WORK_DATE_FORMAT = "%Y-%m-%d"
+
+# Number of state entries fetched per page when refreshing the cache.
+STATE_PAGE_SIZE = 1000
+
+class QueueFullError(Exception):
+    '''The REST API refused a batch because the validator is overloaded.'''
+
 def _hash(data):
     return hashlib.sha512(data).hexdigest()
 
+def _get_address(vin):
+    return _hash(FAMILY_NAME.encode('utf-8'))[0:6] + \
+        _hash(vin.encode('utf-8'))[0:64]
+
+# Summaries live under the namespace plus this marker; the processor
+# refuses vehicles whose address would fall under it.
+SUMMARY_MARKER = "ffffffff"
+
+def _get_summary_prefix():
+    return _hash(FAMILY_NAME.encode('utf-8'))[0:6] + SUMMARY_MARKER
+
+def _get_summary_address(vin):
+    return _get_summary_prefix() + _hash(vin.encode('utf-8'))[0:56]
+
+def _find_separator(record, separators):
+    '''Return why a value of record can't be sent unescaped, or None.
+
+       Payloads are joined with "," (and batch records with newlines)
+       without escaping, so such values would shift or split fields.
+    '''
+    for val in record:
+        for separator in separators:
+            if separator in str(val):
+                return "value {!r} contains {!r}".format(str(val), separator)
+    return None
+
+def _check_record(record):
+    '''Return why the processor would reject the record's fields, or None.'''
+    if len(record) != RECORD_FIELDS:
+        return "record has {} fields, expected {}".format(
+            len(record), RECORD_FIELDS)
+    reason = _find_separator(record, ",")
+    if reason is not None:
+        return reason
+    if record[0] not in OPERATIONS:
+        return "unhandled action {}".format(record[0])
+    if not record[1]:
+        return "empty VIN"
+    if _get_address(record[1]).startswith(_get_summary_prefix()):
+        return "VIN {} maps into the summary address space".format(record[1])
+    if len(record[2]) != 64 or \
+            any(c not in "0123456789abcdefABCDEF" for c in record[2]):
+        return "private key is not 64 hex digits"
+    try:
+        time.strptime(record[3], WORK_DATE_FORMAT)
+    except ValueError:
+        return "work date {} is not in format {}".format(
+            record[3], WORK_DATE_FORMAT)
+    if record[0] in ("add", "delete"):
+        if not all(code.isdecimal() for code in record[4].split("|")):
+            return "work {} is not a list of numeric codes".format(record[4])
+        if not record[5].isdecimal():
+            return "mileage {} is not an integer".format(record[5])
+    return None
+
 
 class CarLoggerClient(object):
     '''Client car logger class.
@@ -32,10 +116,12 @@ class CarLoggerClient(object):
     This supports create, add, delete, history functions.
     '''
 
-    def __init__(self, baseUrl, private_key=None, vin=''):
+    def __init__(self, baseUrl, private_key=None, vin='', precheck=False):
         '''Initialize the client class.
 
            This is mainly getting the key pair and computing the address.
+           With precheck, records the processor would reject are dropped
+           before signing, see check().
         '''
 
         self._baseUrl = baseUrl
@@ -50,8 +136,123 @@ class CarLoggerClient(object):
 
         self._publicKey = self._signer.get_public_key().as_hex()
         self.VIN = vin
-        self._address = _hash(FAMILY_NAME.encode('utf-8'))[0:6] + \
-            _hash(self.VIN.encode('utf-8'))[0:64]
+        self._address = _get_address(self.VIN)
+
+        # In-flight window of batch_many(), adapted AIMD-style.
+        self._window = 1.0
+        self._rejections = 0
+        self._dropped = 0
+
+        # Addresses known to exist. After refresh_state() the set covers
+        # the whole namespace, else only the addresses in _looked_up.
+        self._precheck = precheck
+        self._existing = set()
+        self._looked_up = set()
+        self._complete = False
+        self._doomed = []
+
+    @property
+    def window(self):
+        '''Number of batches batch_many() currently keeps pending.'''
+        return int(self._window)
+
+    @property
+    def rejections(self):
+        '''Number of submissions refused because the queue was full.'''
+        return self._rejections
+
+    @property
+    def dropped(self):
+        '''Number of batches the validator reported UNKNOWN (dropped).'''
+        return self._dropped
+
+    @property
+    def doomed(self):
+        '''(record, reason) pairs dropped by the precheck so far.'''
+        return self._doomed
+
+    def refresh_state(self):
+        '''Reload the addresses of all vehicles with a paged prefix read.'''
+        prefix = _hash(FAMILY_NAME.encode('utf-8'))[0:6]
+        self._existing = set(
+            entry["address"] for entry in self._read_prefix(prefix))
+        self._complete = True
+
+    def summaries(self, vins=None):
+        '''Fetch vehicle summaries with one paged prefix read.
+
+           Returns a dict from VIN to its summary (brand, model, mileage,
+           last_service, service_count), limited to vins when given.
+        '''
+        result = {}
+        for entry in self._read_prefix(_get_summary_prefix()):
+            summary = json.loads(base64.b64decode(entry["data"]).decode())
+            if vins is None or summary["VIN"] in vins:
+                result[summary["VIN"]] = summary
+        return result
+
+    def _read_prefix(self, prefix):
+        '''Yield all state entries under prefix, one page at a time.'''
+        suffix = "state?address={}&limit={}".format(prefix, STATE_PAGE_SIZE)
+        result = yaml.safe_load(self._send_to_restapi(suffix))
+        while True:
+            for entry in result["data"]:
+                yield entry
+            position = result.get("paging", {}).get("next_position")
+            if not position:
+                break
+            result = yaml.safe_load(self._send_to_restapi(
+                "{}&head={}&start={}".format(suffix, result["head"], position)))
+
+    def check(self, records):
+        '''Evaluate records with the processor's rules against cached state.
+
+           Records are checked in order, so a create makes later records for
+           the same VIN valid. State is fetched on first use and cached:
+           a single unknown VIN is read on its own, more refresh the whole
+           namespace. Returns the accepted records and a list of
+           (record, reason) for the rest.
+        '''
+        if not self._complete:
+            unknown = set(_get_address(str(record[1])) for record in records
+                          if len(record) > 1) - self._looked_up
+            if len(unknown) == 1:
+                address = unknown.pop()
+                # A full address is a prefix matching only itself
+                self._existing.update(
+                    entry["address"] for entry in self._read_prefix(address))
+                self._looked_up.add(address)
+            elif unknown:
+                self.refresh_state()
+        existing = set(self._existing)
+        accepted = []
+        rejected = []
+        for record in records:
+            record = [str(val) for val in record]
+            reason = _check_record(record)
+            if reason is None:
+                address = _get_address(record[1])
+                if record[0] == "create" and address in existing:
+                    reason = "VIN {} already exists".format(record[1])
+                elif record[0] != "create" and address not in existing:
+                    reason = "VIN {} does not exist".format(record[1])
+            if reason is None:
+                existing.add(address)
+                accepted.append(record)
+            else:
+                rejected.append((record, reason))
+        return accepted, rejected
+
+    def _apply_precheck(self, records):
+        '''Drop the records check() rejects and remember new VINs.'''
+        if not self._precheck:
+            return records
+        accepted, rejected = self.check(records)
+        for record, reason in rejected:
+            LOGGER.warning('Not sending {}: {}'.format(",".join(record), reason))
+        self._doomed.extend(rejected)
+        self._existing.update(_get_address(record[1]) for record in accepted)
+        return accepted
 
     # For each valid cli command in _cli.py file,
     # add methods to:
@@ -68,6 +269,91 @@ class CarLoggerClient(object):
     def delete(self,  VIN , keyfile , work_date , work , km_status , description):
         return self._wrap_and_send("delete", VIN , keyfile , work_date , work , km_status , description)
 
+    def batch(self, records):
+        '''Send many records in one transaction.
+
+           Each record is a sequence (action, VIN, keyfile, work_date, ...)
+           with the same values create/add/delete take. The processor
+           rejects the whole transaction if any record is invalid.
+        '''
+        records = self._apply_precheck(records)
+        if not records:
+            raise Exception("No valid records left to send")
+        return self._submit([self._make_records_batch(records)])
+
+    def batch_many(self, record_groups):
+        '''Send each group of records as its own batch transaction.
+
+           At most window batches are pending at a time. The window grows
+           by one batch per window of commits and halves whenever the
+           REST API reports a full queue, for submissions and status polls
+           alike, or a batch comes back UNKNOWN, i.e. dropped by the
+           validator. Dropped batches are resubmitted up to MAX_RETRIES
+           times. The run keeps going until every batch is settled.
+           Returns the number of committed, invalid and lost batches.
+        '''
+        groups = [self._apply_precheck(group) for group in record_groups]
+        groups = [group for group in groups if group]
+        groups.reverse()
+        # Signed batches by id, so dropped ones can be resent as they are.
+        pending = {}
+        resend = []
+        resent = {}
+        committed = 0
+        invalid = 0
+        lost = 0
+        attempt = 0
+        while groups or pending or resend:
+            try:
+                while (resend or groups) and len(pending) < self.window:
+                    if not resend:
+                        resend.append(self._make_records_batch(groups.pop()))
+                    batch = resend[-1]
+                    self._send_to_restapi(
+                        "batches",
+                        BatchList(batches=[batch]).SerializeToString(),
+                        'application/octet-stream')
+                    pending[batch.header_signature] = resend.pop()
+
+                statuses = []
+                if pending:
+                    result = self._send_to_restapi(
+                        "batch_statuses?wait=1", json.dumps(list(pending)),
+                        'application/json')
+                    statuses = json.loads(result)['data']
+            except QueueFullError as err:
+                # Keep going with a smaller window; nothing pending is lost.
+                self._back_off(attempt, err)
+                attempt = min(attempt + 1, MAX_RETRIES)
+                continue
+            attempt = 0
+
+            for status in statuses:
+                if status['status'] == 'PENDING':
+                    continue
+                batch = pending.pop(status['id'])
+                if status['status'] == 'COMMITTED':
+                    committed += 1
+                    self._window = min(MAX_WINDOW,
+                                       self._window + 1 / self._window)
+                elif status['status'] == 'UNKNOWN':
+                    self._dropped += 1
+                    self._window = max(1.0, self._window / 2)
+                    resent[status['id']] = resent.get(status['id'], 0) + 1
+                    if resent[status['id']] <= MAX_RETRIES:
+                        LOGGER.info('Batch {} was dropped, resubmitting'
+                                    .format(status['id']))
+                        resend.append(batch)
+                    else:
+                        lost += 1
+                        LOGGER.warning('Batch {} dropped {} times, giving up'
+                                       .format(status['id'], MAX_RETRIES + 1))
+                else:
+                    invalid += 1
+                    LOGGER.warning('Batch {} is {}'.format(
+                        status['id'], status['status']))
+        return committed, invalid, lost
+
     def history(self):
         result = self._send_to_restapi("state/{}".format(self._address))
         try:
@@ -76,6 +362,82 @@ class CarLoggerClient(object):
         except BaseException:
             return None
 
+    def watch(self, vins=None, callback=None):
+        '''Stream committed state changes for the given VINs.
+
+           Without VINs the whole carLogger namespace is watched. Each
+           change is passed to callback as (block_num, address, entry),
+           where entry is the decoded vehicle entry or None if the address
+           was deleted. The subscription is reopened after a dropped
+           connection, catching up from the last block seen.
+        '''
+        if vins:
+            prefixes = [_get_address(vin) for vin in vins]
+        else:
+            prefixes = [_hash(FAMILY_NAME.encode('utf-8'))[0:6]]
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        # Updated as each block arrives, so progress survives a connection
+        # dying with an exception.
+        progress = {'block_id': None}
+        try:
+            while True:
+                try:
+                    loop.run_until_complete(
+                        self._watch_once(prefixes, callback, progress))
+                except (aiohttp.ClientError, OSError) as err:
+                    LOGGER.warning('Subscription lost: {}'.format(err))
+                LOGGER.info('Reconnecting in {}s'.format(
+                    WATCH_RECONNECT_DELAY))
+                loop.run_until_complete(asyncio.sleep(WATCH_RECONNECT_DELAY))
+        finally:
+            loop.close()
+
+    async def _watch_once(self, prefixes, callback, progress):
+        '''Run one websocket subscription until it closes.
+
+           Resumes from progress['block_id'] and stores the id of every
+           block received there, so the next subscription can resume from
+           it. A subscription error (e.g. an unknown last block after a
+           fork) resets it to None, so the next subscription starts from
+           the current head.
+        '''
+        url = self._baseUrl
+        if url.startswith("http://"):
+            url = url[len("http://"):]
+        url = "ws://{}/subscriptions".format(url)
+
+        request = {'action': 'subscribe', 'address_prefixes': prefixes}
+        if progress['block_id'] is not None:
+            request['last_known_block_ids'] = [progress['block_id']]
+
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(url) as websocket:
+                await websocket.send_str(json.dumps(request))
+                async for msg in websocket:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    delta = json.loads(msg.data)
+                    if 'block_id' not in delta:
+                        # Subscription errors are reported without a block
+                        # and leave the socket unsubscribed.
+                        LOGGER.warning('Subscription error: {}'.format(delta))
+                        progress['block_id'] = None
+                        await websocket.close()
+                        return
+                    for change in delta.get('state_changes', []):
+                        if change['address'].startswith(_get_summary_prefix()):
+                            continue
+                        entry = None
+                        if change.get('type') == 'SET':
+                            entry = json.loads(
+                                base64.b64decode(change['value']).decode())
+                        if callback is not None:
+                            callback(delta['block_num'], change['address'],
+                                     entry)
+                    progress['block_id'] = delta['block_id']
+
     def _send_to_restapi(self, suffix, data=None, contentType=None):
         '''Send a REST command to the Validator via the REST API.'''
 
@@ -95,6 +457,10 @@ class CarLoggerClient(object):
             else:
                 result = requests.get(url, headers=headers)
 
+            if result.status_code in (429, 503):
+                raise QueueFullError("Error {}: {}".format(
+                    result.status_code, result.reason))
+
             if not result.ok:
                 raise Exception("Error {}: {}".format(
                     result.status_code, result.reason))
@@ -103,6 +469,9 @@ class CarLoggerClient(object):
             raise Exception(
                 'Failed to connect to {}: {}'.format(url, str(err)))
 
+        except QueueFullError:
+            raise
+
         except BaseException as err:
             raise Exception(err)
 
@@ -113,6 +482,13 @@ class CarLoggerClient(object):
            Even single transactions must be wrapped into a batch.
         '''
 
+        reason = _find_separator(values, ",")
+        if reason is not None:
+            raise Exception("Not sent: {}".format(reason))
+
+        if not self._apply_precheck([(action,) + values]):
+            raise Exception("Not sent: {}".format(self._doomed[-1][1]))
+
         # Generate a csv utf-8 encoded string as payload
         rawPayload = action
 
@@ -122,9 +498,29 @@ class CarLoggerClient(object):
         payload = rawPayload.encode()
 
         # Construct the address where we'll store our state
-        address = self._address
-        inputAddressList = [address]
-        outputAddressList = [address]
+        return self._submit([self._make_batch(
+            payload, [self._address, _get_summary_address(self.VIN)])])
+
+    def _make_records_batch(self, records):
+        '''Build a batch holding one "batch" transaction for records.'''
+        lines = ["batch"]
+        for record in records:
+            reason = _find_separator(record, ",\n")
+            if reason is not None:
+                raise Exception("Not sent, record {}: {}".format(
+                    len(lines), reason))
+            lines.append(",".join([str(val) for val in record]))
+        vins = set(record[1] for record in records)
+        addresses = sorted([_get_address(vin) for vin in vins] +
+                           [_get_summary_address(vin) for vin in vins])
+        return self._make_batch("\n".join(lines).encode(), addresses)
+
+    def _make_batch(self, payload, addresses):
+        '''Sign a transaction for payload touching addresses and wrap it
+           in a batch.
+        '''
+        inputAddressList = addresses
+        outputAddressList = addresses
 
         # Create a TransactionHeader
         header = TransactionHeader(
@@ -160,8 +556,30 @@ class CarLoggerClient(object):
             transactions=transactionList,
             header_signature=self._signer.sign(header))
 
-        # Create a Batch List from Batch above
-        batch_list = BatchList(batches=[batch])
-
-        # Send batch_list to rest-api
-        return self._send_to_restapi("batches", batch_list.SerializeToString(), 'application/octet-stream')
+        return batch
+
+    def _submit(self, batches):
+        '''Send batches to the rest-api, backing off while it is overloaded.'''
+
+        # Create a Batch List from the batches
+        batch_list = BatchList(batches=batches).SerializeToString()
+
+        for attempt in range(MAX_RETRIES):
+            try:
+                return self._send_to_restapi(
+                    "batches", batch_list, 'application/octet-stream')
+            except QueueFullError as err:
+                self._back_off(attempt, err)
+
+        raise QueueFullError(
+            'Validator queue still full after {} attempts'.format(MAX_RETRIES))
+
+    def _back_off(self, attempt, err):
+        '''Count a rejection, halve the window and sleep with jitter.'''
+        self._rejections += 1
+        self._window = max(1.0, self._window / 2)
+        delay = random.uniform(
+            0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+        LOGGER.info('{}, retrying in {:.1f}s (window {})'.format(
+            err, delay, self.window))
+        time.sleep(delay)
@@ -0,0 +1,107 @@
+'''
+Tests for the carLogger client precheck and batch submission, run without
+a REST API.
+'''
+
+import json
+import unittest
+from unittest import mock
+
+from logger.carLogger_client import CarLoggerClient
+from logger.carLogger_client import QueueFullError
+from logger.carLogger_client import _get_address
+
+PRIVATE_KEY = '5b00c8e6e4c0a8507e14d14c8618ad7a22de4920550b69debc43c8b5bb2271c0'
+
+
+def create(VIN):
+    return ['create', VIN, PRIVATE_KEY, '2018-01-02', 'VW', 'Golf', 'new']
+
+
+def add(VIN, mileage='100'):
+    return ['add', VIN, PRIVATE_KEY, '2018-01-03', '1|2', mileage, 'service']
+
+
+class TestCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.client = CarLoggerClient('http://rest-api:8008', PRIVATE_KEY)
+        self.state = {_get_address('OLD')}
+        self.reads = []
+        self.client._read_prefix = self.read_prefix
+
+    def read_prefix(self, prefix):
+        self.reads.append(prefix)
+        return [{"address": address} for address in sorted(self.state)
+                if address.startswith(prefix)]
+
+    def test_records_are_checked_in_order(self):
+        accepted, rejected = self.client.check([
+            add('NEW'), create('NEW'), add('NEW'), create('NEW'),
+            create('OLD'), add('OLD')])
+        self.assertEqual(accepted, [create('NEW'), add('NEW'), add('OLD')])
+        self.assertEqual([record for record, reason in rejected],
+                         [add('NEW'), create('NEW'), create('OLD')])
+
+    def test_malformed_records_are_rejected(self):
+        accepted, rejected = self.client.check([
+            add('OLD', mileage='²'), add('OLD')[:5], ['add', 'OLD,X'] +
+            add('OLD')[2:]])
+        self.assertEqual(accepted, [])
+        self.assertEqual(len(rejected), 3)
+
+    def test_single_vin_reads_its_address_only(self):
+        self.client.check([add('OLD'), add('OLD')])
+        self.client.check([add('OLD')])
+        self.assertEqual(self.reads, [_get_address('OLD')])
+
+    def test_many_vins_refresh_the_namespace(self):
+        self.client.check([add('OLD'), create('NEW')])
+        self.client.check([add('OTHER')])
+        self.assertEqual(self.reads, [_get_address('OLD')[:6]])
+
+    def test_precheck_remembers_accepted_creates(self):
+        self.client._precheck = True
+        self.client._apply_precheck([create('NEW')])
+        self.assertEqual(self.client._apply_precheck([create('NEW')]), [])
+        self.assertEqual(len(self.client.doomed), 1)
+
+
+class TestBatchMany(unittest.TestCase):
+
+    def setUp(self):
+        self.client = CarLoggerClient('http://rest-api:8008', PRIVATE_KEY)
+        self.statuses = []
+        self.sent = []
+        self.client._send_to_restapi = self.send_to_restapi
+
+    def send_to_restapi(self, suffix, data=None, contentType=None):
+        if suffix == "batches":
+            self.sent.append(data)
+            return '{}'
+        status = self.statuses.pop(0)
+        if isinstance(status, Exception):
+            raise status
+        return json.dumps({'data': [{'id': batch_id, 'status': status}
+                                    for batch_id in json.loads(data)]})
+
+    @mock.patch('time.sleep')
+    def test_dropped_batches_are_resubmitted(self, sleep):
+        self.statuses = ['PENDING', QueueFullError('Error 429'), 'UNKNOWN',
+                         'COMMITTED']
+        result = self.client.batch_many([[create('NEW')]])
+        self.assertEqual(result, (1, 0, 0))
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.sent[0], self.sent[1])
+        self.assertEqual(self.client.dropped, 1)
+        self.assertEqual(self.client.rejections, 1)
+
+    @mock.patch('time.sleep')
+    def test_invalid_and_lost_batches_are_reported_apart(self, sleep):
+        self.statuses = ['INVALID'] + ['UNKNOWN'] * 9
+        result = self.client.batch_many([[create('A')], [create('B')]])
+        self.assertEqual(result, (0, 1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
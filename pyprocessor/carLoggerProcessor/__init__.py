@@ -3,5 +3,6 @@ Define files for the transaction walletprocessor package in this directory.
 '''
 
 __all__ = [
-    'carLogger_tp'
+    'carLogger_tp',
+    'carLogger_profiler'
 ]
\ No newline at end of file
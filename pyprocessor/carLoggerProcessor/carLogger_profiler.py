@@ -0,0 +1,164 @@
+
+'''
+Profiling support for the carLogger transaction processor.
+'''
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of transactions profiled per window unless told otherwise.
+DEFAULT_WINDOW = 1000
+
+# Seconds between two stack samples taken for the flamegraph dump.
+SAMPLE_INTERVAL = 0.001
+
+class ApplyProfiler:
+    '''
+    Profiles a window of transactions passed through the handler.
+
+    While active, each call to run() is recorded with cProfile and a
+    sampler thread, running for the whole window, samples the stack of the
+    thread inside run() for a flamegraph. After window transactions a
+    pstats report (.txt) and a folded stack dump (.folded, usable by
+    flamegraph.pl) are written to output_dir and the profiler switches
+    itself off again.
+    '''
+
+    def __init__(self, window=DEFAULT_WINDOW, output_dir='.'):
+        self._window = window
+        self._output_dir = output_dir
+        self._lock = threading.Lock()
+        self._active = False
+        self._toggle_requested = False
+        self._profile = None
+        self._stacks = {}
+        self._count = 0
+        self._thread_id = None
+        self._sampler = None
+        self._stop_sampling = None
+        self._windows = 0
+
+    @property
+    def active(self):
+        return self._active
+
+    def start(self):
+        '''Start a new profiling window.'''
+        with self._lock:
+            self._start()
+
+    def toggle(self, signum=None, frame=None):
+        '''Request starting or stopping a window; usable as a signal handler.
+
+           Only a flag is set here, the next run() acts on it. Signal
+           handlers run on the thread applying transactions, so waiting for
+           the lock here could wait on the interrupted apply forever.
+        '''
+        self._toggle_requested = True
+
+    def run(self, func, *args):
+        '''Call func(*args), profiling it if a window is active.'''
+        if not (self._active or self._toggle_requested):
+            return func(*args)
+        # Never wait: if a window is being started or written elsewhere,
+        # this transaction just runs unprofiled.
+        if not self._lock.acquire(blocking=False):
+            return func(*args)
+        try:
+            if self._toggle_requested:
+                self._toggle_requested = False
+                if self._active:
+                    self._dump()
+                else:
+                    self._start()
+            if not self._active:
+                return func(*args)
+            self._thread_id = threading.get_ident()
+            try:
+                return self._profile.runcall(func, *args)
+            finally:
+                self._thread_id = None
+                self._count += 1
+                if self._count >= self._window:
+                    self._dump()
+        finally:
+            self._lock.release()
+
+    def _start(self):
+        if not os.path.isdir(self._output_dir) or \
+                not os.access(self._output_dir, os.W_OK):
+            LOGGER.warning('Not profiling, {} is not a writable directory'
+                           .format(self._output_dir))
+            return
+        self._profile = cProfile.Profile()
+        self._stacks = {}
+        self._count = 0
+        self._windows += 1
+        self._stop_sampling = threading.Event()
+        self._sampler = threading.Thread(
+            target=self._sample, args=(self._stop_sampling,))
+        self._sampler.daemon = True
+        self._sampler.start()
+        self._active = True
+        LOGGER.info('Profiling the next {} transactions'.format(self._window))
+
+    def _sample(self, stop_sampling):
+        while not stop_sampling.wait(SAMPLE_INTERVAL):
+            thread_id = self._thread_id
+            if thread_id is None:
+                continue
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+
+    def _dump(self):
+        '''End the window and write its report.
+
+           Write errors are logged, never raised: they must not fail the
+           transaction or the signal handler that ended the window.
+        '''
+        self._active = False
+        self._stop_sampling.set()
+        self._sampler.join()
+        if self._count == 0:
+            LOGGER.info('Profiling stopped before any transaction was applied')
+            return
+
+        prefix = os.path.join(
+            self._output_dir,
+            'carLogger-tp-{}-{}-{}'.format(
+                time.strftime("%Y%m%d-%H%M%S"), os.getpid(), self._windows))
+
+        report = io.StringIO()
+        report.write('{} transactions profiled\n\n'.format(self._count))
+        stats = pstats.Stats(self._profile, stream=report)
+        stats.sort_stats('cumulative').print_stats()
+        try:
+            with open(prefix + '.txt', 'w') as report_file:
+                report_file.write(report.getvalue())
+
+            with open(prefix + '.folded', 'w') as folded_file:
+                for stack, count in sorted(self._stacks.items()):
+                    folded_file.write('{} {}\n'.format(stack, count))
+        except OSError as err:
+            LOGGER.warning('Dropping profile of {} transactions: {}'
+                           .format(self._count, err))
+            return
+
+        LOGGER.info('Profile of {} transactions written to {}.txt/.folded'
+                    .format(self._count, prefix))
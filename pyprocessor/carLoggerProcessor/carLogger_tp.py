@@ -3,15 +3,21 @@
 Transaction family class for carLogger.
 '''
 
+import collections
 import hashlib
 import logging
+import os
+import signal
+import threading
 import time
 import sys
+import traceback
 import argparse
 import json
 import pkg_resources
 
 from sawtooth_signing import create_context
+from sawtooth_signing import ParseError
 
 from sawtooth_sdk.processor.handler import TransactionHandler
 from sawtooth_sdk.processor.exceptions import InvalidTransaction
@@ -20,10 +26,24 @@ from sawtooth_sdk.processor.core import TransactionProcessor
 from sawtooth_signing.secp256k1 import Secp256k1PrivateKey
 from sawtooth_signing import CryptoFactory
 
+from carLoggerProcessor.carLogger_profiler import ApplyProfiler
+from carLoggerProcessor.carLogger_profiler import DEFAULT_WINDOW
+
 LOGGER = logging.getLogger(__name__)
 
 FAMILY_NAME = "carLogger"
 
+# Event type emitted after every successful state change, so subscribers can
+# filter on it (and on the VIN/worker/operation attributes) instead of polling.
+EVENT_TYPE = FAMILY_NAME + "/vehicle-updated"
+
+# Operations understood by the processor, and the CSV fields each one needs.
+OPERATIONS = ("create", "add", "delete")
+RECORD_FIELDS = 7
+
+# Format of the work_date field, e.g. 2018-05-31.
+WORK_DATE_FORMAT = "%Y-%m-%d"
+
 def _hash(data):
     '''Compute the SHA-512 hash and return the result as hex characters.'''
     return hashlib.sha512(data).hexdigest()
@@ -31,6 +51,13 @@ def _hash(data):
 # Prefix for carLogger is the first six hex digits of SHA-512(TF name).
 sw_namespace = _hash(FAMILY_NAME.encode('utf-8'))[0:6]
 
+# Summaries live under their own prefix so they can be read in one prefix
+# read, apart from the vehicle entries. Vehicle addresses are plain hashes
+# and could land there too, so the processor refuses to write any vehicle
+# whose address starts with this marker (one VIN in 2^32).
+SUMMARY_MARKER = "ffffffff"
+summary_namespace = sw_namespace + SUMMARY_MARKER
+
 class VehicleLog:
     def __init__(self, VIN, worker, work_date, work='', brand='', model='', description='', mileage=0, timestamp=''):
         self.VIN = VIN
@@ -43,6 +70,40 @@ class VehicleLog:
         self.mileage = mileage
         self.timestamp = timestamp
 
+class VehicleSummary:
+    '''Small per-VIN rollup kept next to the vehicle entry for dashboards.'''
+
+    def __init__(self, VIN, brand='', model='', mileage=0, last_service='', service_count=0):
+        self.VIN = VIN
+        self.brand = brand
+        self.model = model
+        self.mileage = mileage
+        self.last_service = last_service
+        self.service_count = service_count
+
+    def update(self, operation, log):
+        '''Fold one create/add/delete into the summary.
+
+           Mileage is that of the latest record, like in the vehicle entry;
+           last_service stays empty until the first add.
+        '''
+        if operation == "create":
+            self.brand = log.brand
+            self.model = log.model
+            self.mileage = 0
+            self.last_service = ''
+            self.service_count = 0
+            return
+        self.mileage = int(log.mileage)
+        if operation == "add":
+            self.last_service = log.work_date
+            self.service_count += 1
+        else:
+            self.service_count = max(0, self.service_count - 1)
+
+    def encode(self):
+        return json.dumps(self.__dict__, separators=(',', ':')).encode('utf-8')
+
 class CarLoggerTransactionHandler(TransactionHandler):
     '''                                                       
     Transaction Processor class for the carLogger transaction family.
@@ -51,8 +112,19 @@ class CarLoggerTransactionHandler(TransactionHandler):
     It implements functions to add, delete and find transactions.
     '''
 
-    def __init__(self, namespace_prefix):
+    def __init__(self, namespace_prefix, profiler=None):
         self._namespace_prefix = namespace_prefix
+        self._profiler = profiler
+        self._rejections_lock = threading.Lock()
+        self._early_rejections = collections.Counter()
+
+    @property
+    def early_rejections(self):
+        '''Transactions rejected before any key derivation or state read,
+           counted per reason.
+        '''
+        with self._rejections_lock:
+            return dict(self._early_rejections)
 
     @property
     def family_name(self):
@@ -68,15 +140,100 @@ class CarLoggerTransactionHandler(TransactionHandler):
 
     def apply(self, transaction, context):
         '''This implements the apply function for this transaction handler.
-                                                              
-           This function does most of the work for this class by processing
+
+           Runs the transaction through the profiler when one is set.
+        '''
+        if self._profiler is not None:
+            return self._profiler.run(self._apply, transaction, context)
+        return self._apply(transaction, context)
+
+    def _apply(self, transaction, context):
+        '''This function does most of the work for this class by processing
            a single transaction for the carLogger transaction family.
         '''
         LOGGER.debug("start" )
         # Get the payload and extract carLogger-specific information.
         header = transaction.header
         from_key = header.signer_public_key
-        payload_list = transaction.payload.decode().split(",")
+        is_batch, records = self._validate_payload(transaction.payload)
+        try:
+            decoded = [self._decode_record(record) for record in records]
+        except ParseError as err:
+            raise InvalidTransaction('Invalid private key: {}'.format(err))
+        if is_batch:
+            self._batch(context, decoded, header)
+            return
+        operation, log = decoded[0]
+        # Perform the operation.
+        LOGGER.info("Operation = "+ operation)
+        self._update_vehicle(context, operation, log, header)
+
+    def _validate_payload(self, payload):
+        '''Check the payload without touching crypto or the validator.
+
+           Returns whether the payload is a batch and its CSV records as
+           lists of fields, or raises InvalidTransaction so malformed
+           transactions never get into a block.
+        '''
+        try:
+            text = payload.decode()
+        except UnicodeDecodeError:
+            self._reject("encoding", "Payload is not valid UTF-8")
+        lines = text.split("\n")
+        is_batch = lines[0] == "batch"
+        if is_batch:
+            lines = lines[1:]
+            if not lines:
+                self._reject("structure", "Batch contains no records")
+        else:
+            # A single record may still hold newlines in its description.
+            lines = [text]
+        records = [line.split(",") for line in lines]
+        for payload_list in records:
+            self._validate_record(payload_list)
+        return is_batch, records
+
+    def _validate_record(self, payload_list):
+        if len(payload_list) < RECORD_FIELDS:
+            self._reject("structure", "Record has {} fields, expected {}"
+                         .format(len(payload_list), RECORD_FIELDS))
+        operation = payload_list[0]
+        if operation not in OPERATIONS:
+            self._reject("operation", "Unhandled action {}. Operation should "
+                         "be add, delete or create".format(operation))
+        if not payload_list[1]:
+            self._reject("structure", "Record has an empty VIN")
+        if self._get_wallet_address(payload_list[1]).startswith(summary_namespace):
+            self._reject("address", "VIN {} maps into the summary address "
+                         "space".format(payload_list[1]))
+        private_key = payload_list[2]
+        if len(private_key) != 64 or \
+                any(c not in "0123456789abcdefABCDEF" for c in private_key):
+            self._reject("private_key", "Private key is not 64 hex digits")
+        try:
+            time.strptime(payload_list[3], WORK_DATE_FORMAT)
+        except ValueError:
+            self._reject("date", "Work date {} is not in format {}"
+                         .format(payload_list[3], WORK_DATE_FORMAT))
+        if operation in ("add", "delete"):
+            if not all(code.isdecimal() for code in payload_list[4].split("|")):
+                self._reject("work", "Work {} is not a list of numeric codes "
+                             "x|y|z".format(payload_list[4]))
+            if not payload_list[5].isdecimal():
+                self._reject("mileage", "Mileage {} is not an integer"
+                             .format(payload_list[5]))
+
+    def _reject(self, reason, message):
+        '''Count an early rejection and raise InvalidTransaction.'''
+        with self._rejections_lock:
+            self._early_rejections[reason] += 1
+            total = sum(self._early_rejections.values())
+        LOGGER.info('Rejected before state access ({} so far): {}'
+                    .format(total, message))
+        raise InvalidTransaction(message)
+
+    def _decode_record(self, payload_list):
+        '''Turn one validated CSV record into its operation and VehicleLog.'''
         operation = payload_list[0]
         VIN = payload_list[1]
         signer = CryptoFactory(create_context('secp256k1')) \
@@ -84,8 +241,6 @@ class CarLoggerTransactionHandler(TransactionHandler):
         work_date = payload_list[3]
         company = signer.get_public_key().as_hex()
         log = VehicleLog(VIN=VIN, worker=company, work_date=work_date)
-        # Perform the operation.
-        LOGGER.info("Operation = "+ operation)
         if operation == "add":
             work = payload_list[4]
             km_status = payload_list[5]
@@ -94,7 +249,6 @@ class CarLoggerTransactionHandler(TransactionHandler):
             log.mileage = km_status
             log.description = description
             log.timestamp = str(time.strftime("%Y-%m-%d %H:%M"))
-            self._add(context, log)
         elif operation == "delete":
             work = payload_list[4]
             km_status = payload_list[5]
@@ -106,7 +260,6 @@ class CarLoggerTransactionHandler(TransactionHandler):
             for number in work.split("|"):
                 deleted_work = deleted_work + str(-1*int(number))
             log.work = deleted_work
-            self._delete(context, log)
         elif operation == "create":
             brand = payload_list[4]
             model = payload_list[5]
@@ -117,58 +270,138 @@ class CarLoggerTransactionHandler(TransactionHandler):
             log.brand = brand
             log.model = model
             log.timestamp = str(time.strftime("%Y-%m-%d %H:%M"))
-            self._create(context,log)
-        else:
-            LOGGER.info("Unhandled action. Operation should be add, delete, create or history")
+        return operation, log
 
-    def _add(self, context, log):
-        wallet_address = self._get_wallet_address(log.VIN)
-        # wallet_address = self._get_wallet_address(company)
-        LOGGER.info('Got the serial number {} and the wallet address {} '.format(log.VIN, wallet_address))
-        current_entry = context.get_state([wallet_address])
-        new_entry = json.dumps(log.__dict__, indent=4)
-        LOGGER.info('Current entry{}'.format(current_entry))
-        if current_entry == []:
-            LOGGER.info('Serial number {} does not exist yet'.format(log.VIN))
-        else:
-            state_data = str(new_entry).encode('utf-8')
-            addresses = context.set_state({wallet_address: state_data})
-            if len(addresses) < 1:
-                raise InternalError("State Error")
+    def _update_vehicle(self, context, operation, log, header):
+        '''Apply one create/add/delete record and its summary update.
 
-    def _delete(self, context, log):
+           create needs the VIN to be new, add and delete need it to exist.
+        '''
         wallet_address = self._get_wallet_address(log.VIN)
-        # wallet_address = self._get_wallet_address(company)
         LOGGER.info('Got the serial number {} and the wallet address {} '.format(log.VIN, wallet_address))
-        current_entry = context.get_state([wallet_address])
-        new_entry = json.dumps(log.__dict__, indent=4)
+        addresses = [wallet_address]
+        summary_address = self._get_summary_address(log.VIN)
+        if self._declares(header, summary_address):
+            addresses.append(summary_address)
+        current_entry = context.get_state(addresses)
         LOGGER.info('Current entry{}'.format(current_entry))
-        if current_entry == []:
-            LOGGER.info('Serial number {} does not exist yet'.format(log.VIN))
-        else:
-            state_data = str(new_entry).encode('utf-8')
-            addresses = context.set_state({wallet_address: state_data})
-            if len(addresses) < 1:
-                raise InternalError("State Error")
+        entries = {entry.address: entry.data for entry in current_entry}
+        if operation == "create":
+            if wallet_address in entries:
+                raise InvalidTransaction('Serial number {} already in use. Try to add data or get different serial number'.format(log.VIN))
+        elif wallet_address not in entries:
+            raise InvalidTransaction(
+                'Serial number {} does not exist yet'.format(log.VIN))
 
-    def _create(self, context, log):
-        wallet_address = self._get_wallet_address(log.VIN)
-        LOGGER.info('Got the serial number {} and the wallet address {} '.format(log.VIN, wallet_address))
-        current_entry = context.get_state([wallet_address])
         new_entry = json.dumps(log.__dict__, indent=4)
-        LOGGER.info('Current entry{}'.format(current_entry))
-        if current_entry != []:
-             LOGGER.info('Serial number {} already in use. Try to add data or get different serial number'.format(log.VIN))
-        else:
-            state_data = str(new_entry).encode('utf-8')
-            addresses = context.set_state({wallet_address: state_data})
-            if len(addresses) < 1:
-                raise InternalError("State Error")
+        updates = {wallet_address: str(new_entry).encode('utf-8')}
+        if summary_address in addresses:
+            summary = self._load_summary(entries, log.VIN)
+            summary.update(operation, log)
+            updates[summary_address] = summary.encode()
+        addresses = context.set_state(updates)
+        if len(addresses) < len(updates):
+            raise InternalError("State Error")
+        self._emit_event(context, operation, log)
+
+    def _batch(self, context, records, header):
+        '''Apply many create/add/delete records with one state round trip.
+
+           All addresses are read with a single get_state and written with a
+           single set_state. Any invalid record rejects the whole transaction.
+        '''
+        vins = set(log.VIN for operation, log in records)
+        LOGGER.info('Batch of {} records for {} vehicles'.format(
+            len(records), len(vins)))
+        addresses = []
+        summary_vins = set()
+        for VIN in vins:
+            addresses.append(self._get_wallet_address(VIN))
+            summary_address = self._get_summary_address(VIN)
+            if self._declares(header, summary_address):
+                addresses.append(summary_address)
+                summary_vins.add(VIN)
+
+        current_entries = context.get_state(addresses)
+        entries = {entry.address: entry.data for entry in current_entries}
+        summaries = {}
+        updates = {}
+        for operation, log in records:
+            wallet_address = self._get_wallet_address(log.VIN)
+            if operation == "create":
+                if wallet_address in entries:
+                    raise InvalidTransaction(
+                        'Serial number {} already in use'.format(log.VIN))
+            elif wallet_address not in entries:
+                raise InvalidTransaction(
+                    'Serial number {} does not exist yet'.format(log.VIN))
+            if log.VIN in summary_vins:
+                if log.VIN not in summaries:
+                    summaries[log.VIN] = self._load_summary(entries, log.VIN)
+                summaries[log.VIN].update(operation, log)
+            new_entry = json.dumps(log.__dict__, indent=4)
+            updates[wallet_address] = str(new_entry).encode('utf-8')
+            entries[wallet_address] = updates[wallet_address]
+        for VIN, summary in summaries.items():
+            updates[self._get_summary_address(VIN)] = summary.encode()
+
+        addresses = context.set_state(updates)
+        if len(addresses) < len(updates):
+            raise InternalError("State Error")
+        for operation, log in records:
+            self._emit_event(context, operation, log)
+
+    def _declares(self, header, address):
+        '''Whether the transaction lists address in its inputs and outputs.
+
+           Summaries are only kept up to date by transactions that declare
+           the summary address, so family version 1.0 clients written
+           before summaries existed keep working; their updates leave the
+           summary stale until the next update that declares it.
+        '''
+        return any(address.startswith(prefix) for prefix in header.inputs) \
+            and any(address.startswith(prefix) for prefix in header.outputs)
 
+    def _load_summary(self, entries, VIN):
+        '''Get the summary of VIN from entries (address to data).
+
+           Vehicles created before summaries existed get one started from
+           their vehicle entry, with the service count starting at zero.
+        '''
+        summary_address = self._get_summary_address(VIN)
+        if summary_address in entries:
+            return VehicleSummary(**json.loads(entries[summary_address].decode()))
+        summary = VehicleSummary(VIN)
+        wallet_address = self._get_wallet_address(VIN)
+        if wallet_address in entries:
+            vehicle = json.loads(entries[wallet_address].decode())
+            summary.brand = vehicle.get('brand', '')
+            summary.model = vehicle.get('model', '')
+            try:
+                summary.mileage = int(vehicle.get('mileage', 0))
+            except ValueError:
+                pass
+            # A vehicle entry still holding its create record saw no service
+            if vehicle.get('work', '0') != '0':
+                summary.last_service = vehicle.get('work_date', '')
+        return summary
+
+    def _emit_event(self, context, operation, log):
+        '''Emit a carLogger event describing a committed state change.'''
+        data = json.dumps(log.__dict__, separators=(',', ':'), sort_keys=True)
+        context.add_event(
+            event_type=EVENT_TYPE,
+            attributes=[("VIN", log.VIN),
+                        ("worker", log.worker),
+                        ("operation", operation)],
+            data=data.encode('utf-8'))
 
     def _get_wallet_address(self, from_key):
         return _hash(FAMILY_NAME.encode('utf-8'))[0:6] + _hash(from_key.encode('utf-8'))[0:64]
 
+    def _get_summary_address(self, VIN):
+        return summary_namespace + _hash(VIN.encode('utf-8'))[0:56]
+
     def getPublicKey(self, from_key):
         context = create_context('secp256k1')
         public_key = context.get_public_key(from_key)
@@ -192,6 +425,21 @@ def parse_args(args):
                         default=0,
                         help='Increase output sent to stderr')
 
+    parser.add_argument(
+        '--profile',
+        metavar='N',
+        type=int,
+        nargs='?',
+        const=DEFAULT_WINDOW,
+        help='Profile the next N transactions (default {}); SIGUSR1\n'
+             'starts or stops a profiling window at any time'
+        .format(DEFAULT_WINDOW))
+
+    parser.add_argument(
+        '--profile-dir',
+        default='.',
+        help='Directory the profile report and stack dump are written to')
+
     try:
         version = pkg_resources.get_distribution(FAMILY_NAME).version
     except pkg_resources.DistributionNotFound:
@@ -204,7 +452,17 @@ def parse_args(args):
         .format(version),
         help='print version information')
 
-    return parser.parse_args(args)
+    opts = parser.parse_args(args)
+
+    if opts.profile is not None:
+        if opts.profile < 1:
+            parser.error('--profile needs at least 1 transaction')
+        if not os.path.isdir(opts.profile_dir) or \
+                not os.access(opts.profile_dir, os.W_OK):
+            parser.error('--profile-dir {} is not a writable directory'
+                         .format(opts.profile_dir))
+
+    return opts
 
 
 def main(args=None):
@@ -217,7 +475,13 @@ def main(args=None):
         # Register the transaction handler and start it.
         processor = TransactionProcessor(url=opts.connect)
 
-        handler = CarLoggerTransactionHandler(sw_namespace)
+        profiler = ApplyProfiler(window=opts.profile or DEFAULT_WINDOW,
+                                 output_dir=opts.profile_dir)
+        signal.signal(signal.SIGUSR1, profiler.toggle)
+        if opts.profile is not None:
+            profiler.start()
+
+        handler = CarLoggerTransactionHandler(sw_namespace, profiler)
 
         processor.add_handler(handler)
 
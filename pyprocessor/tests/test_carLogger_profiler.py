@@ -0,0 +1,61 @@
+'''
+Tests for the transaction processor's apply profiler.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from carLoggerProcessor.carLogger_profiler import ApplyProfiler
+
+
+class TestApplyProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_window_is_written_after_n_transactions(self):
+        profiler = ApplyProfiler(window=2, output_dir=self.output_dir)
+        profiler.start()
+        self.assertEqual(profiler.run(sum, [1, 2]), 3)
+        self.assertTrue(profiler.active)
+        profiler.run(sum, [1, 2])
+        self.assertFalse(profiler.active)
+        self.assertEqual(sorted(os.path.splitext(name)[1]
+                                for name in os.listdir(self.output_dir)),
+                         ['.folded', '.txt'])
+
+    def test_toggle_takes_effect_on_next_run(self):
+        profiler = ApplyProfiler(window=10, output_dir=self.output_dir)
+        profiler.toggle()
+        self.assertFalse(profiler.active)
+        profiler.run(sum, [1])
+        self.assertTrue(profiler.active)
+        profiler.toggle()
+        profiler.run(sum, [1])
+        self.assertFalse(profiler.active)
+        self.assertEqual(len(os.listdir(self.output_dir)), 2)
+
+    def test_toggle_while_applying_does_not_block(self):
+        profiler = ApplyProfiler(window=10, output_dir=self.output_dir)
+        profiler.start()
+        # A signal arriving in the middle of an apply, on the same thread
+        profiler.run(profiler.toggle)
+        self.assertTrue(profiler.active)
+        profiler.run(sum, [1])
+        self.assertFalse(profiler.active)
+
+    def test_unwritable_directory_disables_profiling(self):
+        profiler = ApplyProfiler(
+            output_dir=os.path.join(self.output_dir, 'missing'))
+        profiler.start()
+        self.assertFalse(profiler.active)
+        self.assertEqual(profiler.run(sum, [1, 2]), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+'''
+Tests for the carLogger transaction handler, run against a fake context.
+'''
+
+import json
+import unittest
+
+from sawtooth_sdk.processor.exceptions import InvalidTransaction
+
+from carLoggerProcessor.carLogger_tp import CarLoggerTransactionHandler
+from carLoggerProcessor.carLogger_tp import EVENT_TYPE
+from carLoggerProcessor.carLogger_tp import sw_namespace
+
+PRIVATE_KEY = '5b00c8e6e4c0a8507e14d14c8618ad7a22de4920550b69debc43c8b5bb2271c0'
+
+
+class StateEntry:
+    def __init__(self, address, data):
+        self.address = address
+        self.data = data
+
+
+class FakeContext:
+    '''Records state calls and only allows declared addresses, like the
+       validator does.'''
+
+    def __init__(self, allowed=(sw_namespace,)):
+        self.allowed = list(allowed)
+        self.state = {}
+        self.events = []
+        self.get_calls = 0
+        self.set_calls = 0
+
+    def _check(self, addresses):
+        for address in addresses:
+            if not any(address.startswith(p) for p in self.allowed):
+                raise AssertionError('Undeclared address {}'.format(address))
+
+    def get_state(self, addresses):
+        self._check(addresses)
+        self.get_calls += 1
+        return [StateEntry(address, self.state[address])
+                for address in addresses if address in self.state]
+
+    def set_state(self, entries):
+        self._check(entries)
+        self.set_calls += 1
+        self.state.update(entries)
+        return list(entries)
+
+    def add_event(self, event_type, attributes=None, data=None):
+        self.events.append((event_type, dict(attributes), data))
+
+
+class FakeHeader:
+    def __init__(self, addresses):
+        self.signer_public_key = ''
+        self.inputs = addresses
+        self.outputs = addresses
+
+
+class FakeTransaction:
+    def __init__(self, payload, addresses=(sw_namespace,)):
+        self.payload = payload.encode()
+        self.header = FakeHeader(list(addresses))
+
+
+def record(operation, VIN, work_date='2018-01-02', *values):
+    return ','.join([operation, VIN, PRIVATE_KEY, work_date] + list(values))
+
+
+def create(VIN, work_date='2018-01-02'):
+    return record('create', VIN, work_date, 'VW', 'Golf', 'new')
+
+
+def add(VIN, work_date='2018-01-03', work='1|2', mileage='100'):
+    return record('add', VIN, work_date, work, mileage, 'service')
+
+
+def delete(VIN, work_date='2018-01-04', work='2', mileage='90'):
+    return record('delete', VIN, work_date, work, mileage, 'fix')
+
+
+class TestCarLoggerHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = CarLoggerTransactionHandler(sw_namespace)
+        self.context = FakeContext()
+
+    def apply(self, payload, addresses=(sw_namespace,)):
+        self.handler.apply(FakeTransaction(payload, addresses), self.context)
+
+    def summary(self, VIN):
+        address = self.handler._get_summary_address(VIN)
+        return json.loads(self.context.state[address].decode())
+
+    def test_validation_rejects_before_state_access(self):
+        bad_payloads = [
+            ('structure', 'add,V1'),
+            ('operation', record('history', 'V1', '2018-01-02', 'a', 'b', 'c')),
+            ('private_key', 'add,V1,xyz,2018-01-02,1,5,d'),
+            ('date', add('V1', work_date='02.01.2018')),
+            ('work', add('V1', work='1|x')),
+            ('mileage', add('V1', mileage='²')),
+            ('mileage', add('V1', mileage='-5')),
+            ('structure', 'batch'),
+        ]
+        for reason, payload in bad_payloads:
+            with self.assertRaises(InvalidTransaction, msg=payload):
+                self.apply(payload)
+
+        self.assertEqual(self.context.get_calls, 0)
+        self.assertEqual(self.handler.early_rejections,
+                         {'structure': 2, 'operation': 1, 'private_key': 1,
+                          'date': 1, 'work': 1, 'mileage': 2})
+
+    def test_duplicate_create_is_invalid(self):
+        self.apply(create('V1'))
+        with self.assertRaises(InvalidTransaction):
+            self.apply(create('V1'))
+
+    def test_add_and_delete_on_missing_vin_are_invalid(self):
+        with self.assertRaises(InvalidTransaction):
+            self.apply(add('V1'))
+        with self.assertRaises(InvalidTransaction):
+            self.apply(delete('V1'))
+        self.assertEqual(self.context.set_calls, 0)
+
+    def test_single_record_keeps_newlines(self):
+        self.apply(create('V1').replace('new', 'line1\nline2'))
+        address = self.handler._get_wallet_address('V1')
+        entry = json.loads(self.context.state[address].decode())
+        self.assertEqual(entry['description'], 'line1\nline2')
+
+    def test_events_are_emitted(self):
+        self.apply(create('V1'))
+        self.apply(add('V1'))
+        self.assertEqual([event[1]['operation'] for event in self.context.events],
+                         ['create', 'add'])
+        self.assertEqual(self.context.events[0][0], EVENT_TYPE)
+        self.assertEqual(self.context.events[0][1]['VIN'], 'V1')
+
+    def test_batch_uses_one_state_round_trip(self):
+        self.apply('\n'.join(['batch', create('V1'), create('V2'), add('V1'),
+                              add('V2'), delete('V1')]))
+        self.assertEqual(self.context.get_calls, 1)
+        self.assertEqual(self.context.set_calls, 1)
+        self.assertEqual(len(self.context.events), 5)
+        self.assertEqual(self.summary('V1')['service_count'], 0)
+        self.assertEqual(self.summary('V2')['service_count'], 1)
+
+    def test_batch_is_rejected_as_a_whole(self):
+        with self.assertRaises(InvalidTransaction):
+            self.apply('\n'.join(['batch', create('V1'), add('V1'),
+                                  add('V2')]))
+        self.assertEqual(self.context.set_calls, 0)
+        self.assertEqual(self.context.state, {})
+        self.assertEqual(self.context.events, [])
+
+    def test_batch_rejects_malformed_record(self):
+        with self.assertRaises(InvalidTransaction):
+            self.apply('\n'.join(['batch', create('V1'), 'add,V1']))
+        self.assertEqual(self.context.get_calls, 0)
+
+    def test_summary_follows_updates(self):
+        self.apply(create('V1'))
+        self.assertEqual(self.summary('V1'),
+                         {'VIN': 'V1', 'brand': 'VW', 'model': 'Golf',
+                          'mileage': 0, 'last_service': '',
+                          'service_count': 0})
+
+        self.apply(add('V1', work_date='2018-02-01', mileage='100000'))
+        self.apply(add('V1', work_date='2018-03-01', mileage='100500'))
+        self.apply(delete('V1', work_date='2018-03-02', mileage='10500'))
+        summary = self.summary('V1')
+        self.assertEqual(summary['mileage'], 10500)
+        self.assertEqual(summary['last_service'], '2018-03-01')
+        self.assertEqual(summary['service_count'], 1)
+        self.assertEqual(summary['brand'], 'VW')
+
+    def test_summary_skipped_when_not_declared(self):
+        vehicle_address = self.handler._get_wallet_address('V1')
+        summary_address = self.handler._get_summary_address('V1')
+        self.context.allowed = [vehicle_address]
+
+        self.apply(create('V1'), [vehicle_address])
+        self.apply('\n'.join(['batch', add('V1')]), [vehicle_address])
+        self.assertNotIn(summary_address, self.context.state)
+
+        # The next declaring transaction starts one from the vehicle entry
+        self.context.allowed = [sw_namespace]
+        self.apply(add('V1', mileage='200'),
+                   [vehicle_address, summary_address])
+        summary = self.summary('V1')
+        self.assertEqual(summary['mileage'], 200)
+        self.assertEqual(summary['service_count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()